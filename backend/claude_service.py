@@ -1,8 +1,15 @@
 """
 Claude API integration service for music notation generation.
 """
-import anthropic
-from config import ANTHROPIC_API_KEY, MODEL
+import functools
+import hashlib
+import re
+import threading
+import time
+from collections import deque
+from xml.etree import ElementTree as ET
+
+from config import get_client, get_async_client, MODEL, HISTORY_WINDOW
 
 SYSTEM_PROMPT = """You are an expert music composition assistant powering an AI-driven music notation IDE.
 Your role is to help users create and edit musical notation using MusicXML format.
@@ -43,19 +50,206 @@ When responding:
 If the user provides current score context, use those exact instruments and settings as your template.
 """
 
+GENERATE_PROMPT = """Generate a musical passage with these specifications:
+- Description: {description}
+- Key: {key}
+- Time signature: {beats}/{beat_type}
+- Length: {measures} measures
+
+Create valid MusicXML that can be imported directly into MuseScore."""
+
+# Prompts that embed a full score are assembled with a single join around it
+EDIT_PROMPT_PREFIX = "Here is the current score:\n```musicxml\n"
+EDIT_PROMPT_INSTRUCTIONS = "\n```\n\nPlease make the following edits: "
+EDIT_PROMPT_SUFFIX = "\n\nReturn the complete modified MusicXML."
+
+ANALYZE_PROMPT_PREFIX = """Analyze this musical score and provide:
+1. Key and time signature
+2. Melodic patterns and motifs
+3. Harmonic analysis
+4. Suggestions for development or improvement
+
+```musicxml
+"""
+ANALYZE_PROMPT_SUFFIX = "\n```"
+
+# The system prompt alone is below the minimum cacheable length, so the prompt cache
+# breakpoint goes on the last assistant turn of the history instead (see _history_for_request)
+_CACHE_CONTROL = {"type": "ephemeral"}
+
+SCORE_CONTEXT_HEADER = "Current full score (MusicXML):\n```musicxml\n"
+_SCORE_CONTEXT_BLOCK = re.compile(r'Current full score \(MusicXML\):\n```musicxml\n.*?\n```\n\n', re.DOTALL)
+PRIOR_SCORE_PLACEHOLDER = "[prior score context omitted]\n\n"
+# Reference left in history in place of an interned score blob
+_SCORE_REF = re.compile(r'<<score:sha1=([0-9a-f]{40})>>')
+
+# Responses this long without a code block are treated as text-only
+XML_PROBE_CHARS = 512
+
+
+class _PartialMusicXMLExtractor:
+    """
+    Incrementally extract renderable partial MusicXML from a streamed response.
+
+    Text from the <score-partwise> start onward is fed to an XMLPullParser,
+    which keeps its state between chunks; measure and part counts come from
+    its events, so no text is rescanned or reparsed.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.score_start = -1
+        self.partlist_closed = False
+        self.last_measure_end = -1
+        self.measure_count = 0
+        self.open_parts_count = 0
+        self.partial = None
+        self.xml_possible = True
+        self._fence_seen = False
+        self._parser = None
+        self._open_parts_at_measure = 0
+        self._body = ""
+
+    def feed(self, chunk: str) -> str | None:
+        """
+        Append a streamed text chunk.
+
+        Returns:
+            The latest partial MusicXML (closed into a parseable document),
+            or None if no complete measure is available yet
+        """
+        scan_from = len(self.text)
+        text = self.text = self.text + chunk
+
+        # Look for the start of MusicXML in a code block
+        if self.score_start == -1:
+            if not self.xml_possible:
+                return None
+            self.score_start = text.find('<score-partwise', max(0, scan_from - 14))
+            if self.score_start == -1:
+                # Give up on plain-text answers that never open a code block
+                if len(text) > XML_PROBE_CHARS and not self._fence_seen:
+                    self._fence_seen = '```' in text
+                    self.xml_possible = self._fence_seen
+                return None
+            self._parser = ET.XMLPullParser(events=('start', 'end'))
+            chunk = text[self.score_start:]
+            scan_from = self.score_start
+
+        # Parsing stops once the score is complete or turned out to be malformed
+        if self._parser is None:
+            return self.partial
+
+        previous_count = self.measure_count
+        self._parser.feed(chunk)
+        try:
+            for event, elem in self._parser.read_events():
+                tag = elem.tag
+                if tag == 'measure':
+                    if event == 'end':
+                        self.measure_count += 1
+                        self._open_parts_at_measure = self.open_parts_count
+                        elem.clear()
+                elif tag == 'part':
+                    self.open_parts_count += 1 if event == 'start' else -1
+                elif event == 'end':
+                    if tag == 'part-list':
+                        self.partlist_closed = True
+                    elif tag == 'score-partwise':
+                        self._parser = None
+                        break
+        except ET.ParseError:
+            self._parser = None
+            self.partial = None
+            return None
+
+        # Must have a complete part-list section (required by OSMD) and new measures
+        if not self.partlist_closed or self.measure_count == previous_count:
+            return self.partial
+
+        # Extend the truncated body up to the last complete measure
+        end = text.rfind('</measure>', max(scan_from - 9, self.last_measure_end, self.score_start))
+        if end == -1:
+            return self.partial
+        self.last_measure_end = end + len('</measure>')
+        self._body += text[self.score_start + len(self._body):self.last_measure_end]
+
+        # Assemble declaration, body, closed parts and score-partwise in one join
+        fragments = ['<?xml version="1.0" encoding="UTF-8"?>\n', self._body]
+        fragments.extend(['\n  </part>'] * self._open_parts_at_measure)
+        fragments.append('\n</score-partwise>')
+        self.partial = ''.join(fragments)
+
+        return self.partial
+
+
+@functools.lru_cache(maxsize=8)
+def _render_context_prefix(current_score_xml: str | None, start: int | None, end: int | None,
+                           selected_xml: str | None) -> str:
+    """Render the score/selection context that precedes the user request."""
+    parts = []
+
+    if current_score_xml:
+        parts.append(SCORE_CONTEXT_HEADER)
+        parts.append(current_score_xml)
+        parts.append("\n```")
+
+    if start and end:
+        if parts:
+            parts.append("\n\n")
+        parts.append(f"User has selected measures {start} to {end}.")
+
+    if selected_xml:
+        if parts:
+            parts.append("\n\n")
+        parts.append("Selected measures (MusicXML):\n```musicxml\n")
+        parts.append(selected_xml)
+        parts.append("\n```")
+
+    if not parts:
+        return ""
+
+    parts.append("\n\nUser request: ")
+    return "".join(parts)
+
 
 class ClaudeService:
     def __init__(self):
-        self.client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
-        self.conversation_history = []
+        self.client = get_client()
+        self.async_client = get_async_client()
+        # Sliding window of the last HISTORY_WINDOW user/assistant turns
+        self.conversation_history = deque(maxlen=2 * HISTORY_WINDOW)
+        # Score blobs referenced from history, keyed by SHA-1 digest
+        self._score_store: dict[str, str] = {}
+        # Requests prepare and record turns from worker threads; interning a score,
+        # appending its turn and pruning the store must not interleave
+        self._history_lock = threading.Lock()
 
     def reset_conversation(self):
         """Clear conversation history for a new session."""
-        self.conversation_history = []
-
-    def chat(self, user_message: str, current_score_xml: str = None, selection_context: dict = None) -> dict:
+        with self._history_lock:
+            self.conversation_history.clear()
+            self._score_store.clear()
+
+    def _intern_score(self, score_xml: str) -> str:
+        """Store a score blob once and return the reference token for it."""
+        digest = hashlib.sha1(score_xml.encode('utf-8')).hexdigest()
+        self._score_store.setdefault(digest, score_xml)
+        return f"<<score:sha1={digest}>>"
+
+    def _prune_score_store(self):
+        """Drop score blobs no longer referenced by any turn in the window."""
+        referenced = set()
+        for message in self.conversation_history:
+            if message["role"] == "user":
+                referenced.update(_SCORE_REF.findall(message["content"]))
+        for digest in self._score_store.keys() - referenced:
+            del self._score_store[digest]
+
+    def _prepare_request(self, user_message: str, current_score_xml: str = None,
+                         selection_context: dict = None) -> list[dict]:
         """
-        Send a message to Claude and get a response.
+        Record the user turn in history and return the messages list to send.
 
         Args:
             user_message: The user's chat message
@@ -63,53 +257,140 @@ class ClaudeService:
             selection_context: Optional dict with start_measure, end_measure, selected_xml
 
         Returns:
-            dict with 'text' (response) and optionally 'musicxml' (generated code)
+            Windowed, score-deduplicated messages for the API call
         """
-        context_parts = []
+        with self._history_lock:
+            context_message = self._build_context_message(user_message, current_score_xml, selection_context)
+
+            self.conversation_history.append({
+                "role": "user",
+                "content": context_message
+            })
+            self._prune_score_store()
+
+            return self._history_for_request()
 
+    def _history_for_request(self) -> list[dict]:
+        """
+        Build the messages list to send from the conversation window.
+
+        Only the latest user turn needs the full score, since the current score
+        is re-sent with every request: its score reference is re-inflated from
+        the score store, while earlier embeddings are replaced with a placeholder.
+
+        Everything before the latest user turn is sent unchanged on the next
+        request, so the last assistant turn carries the prompt cache breakpoint.
+        """
+        messages = list(self.conversation_history)
+
+        # The window may have cut between a user turn and its reply
+        if messages and messages[0]["role"] == "assistant":
+            messages = messages[1:]
+
+        seen_latest_user = False
+        marked_cache = False
+        for i in range(len(messages) - 1, -1, -1):
+            message = messages[i]
+            if message["role"] != "user":
+                if seen_latest_user and not marked_cache:
+                    marked_cache = True
+                    messages[i] = {
+                        "role": "assistant",
+                        "content": [{"type": "text", "text": message["content"], "cache_control": _CACHE_CONTROL}]
+                    }
+                continue
+            content = message["content"]
+            if not seen_latest_user:
+                seen_latest_user = True
+                if '<<score:' in content:
+                    messages[i] = {
+                        "role": "user",
+                        "content": _SCORE_REF.sub(lambda m: self._score_store[m.group(1)], content)
+                    }
+                continue
+            if content.startswith(SCORE_CONTEXT_HEADER):
+                messages[i] = {
+                    "role": "user",
+                    "content": _SCORE_CONTEXT_BLOCK.sub(PRIOR_SCORE_PLACEHOLDER, content, count=1)
+                }
+
+        return messages
+
+    def _build_context_message(self, user_message: str, current_score_xml: str = None,
+                               selection_context: dict = None) -> str:
+        """
+        Prefix the user message with score and selection context, if any.
+
+        The full score is interned and referenced by digest, so history holds
+        each distinct score only once.
+        """
         if current_score_xml:
-            context_parts.append(f"""Current full score (MusicXML):
-```musicxml
-{current_score_xml}
-```""")
+            current_score_xml = self._intern_score(current_score_xml)
 
+        start = end = selected_xml = None
         if selection_context:
             start = selection_context.get("start_measure")
             end = selection_context.get("end_measure")
             selected_xml = selection_context.get("selected_xml")
 
-            if start and end:
-                context_parts.append(f"User has selected measures {start} to {end}.")
+        prefix = _render_context_prefix(current_score_xml, start, end, selected_xml)
+        if not prefix:
+            return user_message
+        return prefix + user_message
 
-            if selected_xml:
-                context_parts.append(f"""Selected measures (MusicXML):
-```musicxml
-{selected_xml}
-```""")
+    def chat(self, user_message: str, current_score_xml: str = None, selection_context: dict = None) -> dict:
+        """
+        Send a message to Claude and get a response.
 
-        if context_parts:
-            context_message = "\n\n".join(context_parts) + f"\n\nUser request: {user_message}"
-        else:
-            context_message = user_message
+        Args:
+            user_message: The user's chat message
+            current_score_xml: Optional MusicXML of the current score for context
+            selection_context: Optional dict with start_measure, end_measure, selected_xml
 
-        self.conversation_history.append({
-            "role": "user",
-            "content": context_message
-        })
+        Returns:
+            dict with 'text' (response) and optionally 'musicxml' (generated code)
+        """
+        messages = self._prepare_request(user_message, current_score_xml, selection_context)
 
         response = self.client.messages.create(
             model=MODEL,
             max_tokens=8192,
             system=SYSTEM_PROMPT,
-            messages=self.conversation_history
+            messages=messages
+        )
+
+        return self._record_response(response.content[0].text)
+
+    async def achat(self, user_message: str, current_score_xml: str = None, selection_context: dict = None) -> dict:
+        """
+        Async variant of chat() that does not block the event loop while waiting on Claude.
+
+        Args:
+            user_message: The user's chat message
+            current_score_xml: Optional MusicXML of the current score for context
+            selection_context: Optional dict with start_measure, end_measure, selected_xml
+
+        Returns:
+            dict with 'text' (response) and optionally 'musicxml' (generated code)
+        """
+        messages = self._prepare_request(user_message, current_score_xml, selection_context)
+
+        response = await self.async_client.messages.create(
+            model=MODEL,
+            max_tokens=8192,
+            system=SYSTEM_PROMPT,
+            messages=messages
         )
 
-        assistant_message = response.content[0].text
+        return self._record_response(response.content[0].text)
 
-        self.conversation_history.append({
-            "role": "assistant",
-            "content": assistant_message
-        })
+    def _record_response(self, assistant_message: str) -> dict:
+        """Store Claude's reply in history and extract any MusicXML from it."""
+        with self._history_lock:
+            self.conversation_history.append({
+                "role": "assistant",
+                "content": assistant_message
+            })
 
         result = {
             "text": assistant_message,
@@ -124,136 +405,59 @@ class ClaudeService:
 
     def _extract_musicxml(self, text: str) -> str | None:
         """Extract MusicXML code from markdown code blocks."""
-        import re
-        pattern = r'```musicxml\s*(.*?)\s*```'
-        match = re.search(pattern, text, re.DOTALL)
-        if match:
-            return match.group(1).strip()
-
-        pattern = r'```xml\s*(.*?)\s*```'
-        match = re.search(pattern, text, re.DOTALL)
-        if match:
-            xml_content = match.group(1).strip()
-            if '<score-partwise' in xml_content or '<score-timewise' in xml_content:
-                return xml_content
+        start = text.find('```musicxml')
+        if start != -1:
+            end = text.find('```', start + 11)
+            if end != -1:
+                return text[start + 11:end].strip()
+
+        start = text.find('```xml')
+        if start != -1:
+            end = text.find('```', start + 6)
+            if end != -1:
+                xml_content = text[start + 6:end].strip()
+                if '<score-partwise' in xml_content or '<score-timewise' in xml_content:
+                    return xml_content
 
         return None
 
-    def _try_extract_partial_musicxml(self, text: str) -> str | None:
-        """Try to extract and complete partial MusicXML for live preview."""
-        import re
-        from xml.etree import ElementTree as ET
-
-        # Look for the start of MusicXML in a code block
-        if '<score-partwise' not in text:
-            return None
-
-        # Must have a complete part-list section (required by OSMD)
-        if '</part-list>' not in text:
-            return None
-
-        # Must have at least one complete measure
-        if '</measure>' not in text:
-            return None
-
-        # Extract everything from score-partwise start
-        match = re.search(r'(<score-partwise[^>]*>.*)', text, re.DOTALL)
-        if not match:
-            return None
-
-        partial = match.group(1)
-
-        # Find the last complete </measure> tag
-        last_measure_end = partial.rfind('</measure>')
-        if last_measure_end == -1:
-            return None
-
-        # Truncate to last complete measure
-        partial = partial[:last_measure_end + len('</measure>')]
-
-        # Add closing tags to make valid XML
-        # Count open parts that need closing
-        open_parts = partial.count('<part ') + partial.count('<part>') - partial.count('</part>')
-
-        # Close open parts
-        for _ in range(open_parts):
-            partial += '\n  </part>'
-
-        # Close score-partwise
-        partial += '\n</score-partwise>'
-
-        # Add XML declaration if missing
-        if not partial.startswith('<?xml'):
-            partial = '<?xml version="1.0" encoding="UTF-8"?>\n' + partial
-
-        # Validate XML is parseable before returning
-        try:
-            ET.fromstring(partial.encode('utf-8'))
-        except ET.ParseError:
-            return None
-
-        return partial
-
-    def chat_stream(self, user_message: str, current_score_xml: str = None, selection_context: dict = None):
+    def chat_stream(self, user_message: str, current_score_xml: str = None, selection_context: dict = None,
+                    min_measure_delta: int = 4, min_interval_ms: int = 150):
         """
         Stream chat response for live score updates.
         Yields chunks with partial MusicXML when available.
-        """
-        context_parts = []
-
-        if current_score_xml:
-            context_parts.append(f"""Current full score (MusicXML):
-```musicxml
-{current_score_xml}
-```""")
-
-        if selection_context:
-            start = selection_context.get("start_measure")
-            end = selection_context.get("end_measure")
-            selected_xml = selection_context.get("selected_xml")
 
-            if start and end:
-                context_parts.append(f"User has selected measures {start} to {end}.")
-
-            if selected_xml:
-                context_parts.append(f"""Selected measures (MusicXML):
-```musicxml
-{selected_xml}
-```""")
-
-        if context_parts:
-            context_message = "\n\n".join(context_parts) + f"\n\nUser request: {user_message}"
-        else:
-            context_message = user_message
-
-        self.conversation_history.append({
-            "role": "user",
-            "content": context_message
-        })
+        Partial updates are throttled: one is emitted once at least
+        min_measure_delta new measures are available, or min_interval_ms has
+        passed since the previous one and there is at least one new measure.
+        """
+        messages = self._prepare_request(user_message, current_score_xml, selection_context)
 
         # Stream the response
-        accumulated_text = ""
+        extractor = _PartialMusicXMLExtractor()
         last_rendered_measures = 0
+        last_emit_time = time.monotonic()
 
         with self.client.messages.stream(
             model=MODEL,
             max_tokens=8192,
             system=SYSTEM_PROMPT,
-            messages=self.conversation_history
+            messages=messages
         ) as stream:
             for text in stream.text_stream:
-                accumulated_text += text
-
                 # Try to extract partial MusicXML
-                partial_xml = self._try_extract_partial_musicxml(accumulated_text)
+                partial_xml = extractor.feed(text)
 
                 if partial_xml:
-                    # Count measures in partial XML
-                    measure_count = partial_xml.count('</measure>')
+                    measure_count = extractor.measure_count
 
-                    # Only yield if we have new measures
-                    if measure_count > last_rendered_measures:
+                    # Only yield if we have enough new measures or enough time has passed
+                    new_measures = measure_count - last_rendered_measures
+                    now = time.monotonic()
+                    if new_measures > 0 and (new_measures >= min_measure_delta or
+                                             (now - last_emit_time) * 1000 >= min_interval_ms):
                         last_rendered_measures = measure_count
+                        last_emit_time = now
                         yield {
                             "type": "partial",
                             "musicxml": partial_xml,
@@ -263,11 +467,14 @@ class ClaudeService:
                     # Yield text progress
                     yield {"type": "text", "content": text}
 
+        accumulated_text = extractor.text
+
         # Store final response in history
-        self.conversation_history.append({
-            "role": "assistant",
-            "content": accumulated_text
-        })
+        with self._history_lock:
+            self.conversation_history.append({
+                "role": "assistant",
+                "content": accumulated_text
+            })
 
         # Yield final complete MusicXML
         final_xml = self._extract_musicxml(accumulated_text)
@@ -300,13 +507,13 @@ class ClaudeService:
         Returns:
             dict with 'text' and 'musicxml'
         """
-        prompt = f"""Generate a musical passage with these specifications:
-- Description: {description}
-- Key: {key}
-- Time signature: {time_sig[0]}/{time_sig[1]}
-- Length: {measures} measures
-
-Create valid MusicXML that can be imported directly into MuseScore."""
+        prompt = GENERATE_PROMPT.format(
+            description=description,
+            key=key,
+            beats=time_sig[0],
+            beat_type=time_sig[1],
+            measures=measures
+        )
 
         return self.chat(prompt)
 
@@ -321,14 +528,8 @@ Create valid MusicXML that can be imported directly into MuseScore."""
         Returns:
             dict with 'text' and 'musicxml' (the edited version)
         """
-        prompt = f"""Here is the current score:
-```musicxml
-{current_xml}
-```
-
-Please make the following edits: {edit_instructions}
-
-Return the complete modified MusicXML."""
+        prompt = ''.join([EDIT_PROMPT_PREFIX, current_xml, EDIT_PROMPT_INSTRUCTIONS,
+                          edit_instructions, EDIT_PROMPT_SUFFIX])
 
         return self.chat(prompt)
 
@@ -342,14 +543,6 @@ Return the complete modified MusicXML."""
         Returns:
             dict with analysis text
         """
-        prompt = f"""Analyze this musical score and provide:
-1. Key and time signature
-2. Melodic patterns and motifs
-3. Harmonic analysis
-4. Suggestions for development or improvement
-
-```musicxml
-{xml_content}
-```"""
+        prompt = ''.join([ANALYZE_PROMPT_PREFIX, xml_content, ANALYZE_PROMPT_SUFFIX])
 
         return self.chat(prompt)
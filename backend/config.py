@@ -1,9 +1,63 @@
+import functools
 import os
+from typing import NamedTuple
+
+import anthropic
+import httpx
 from dotenv import load_dotenv
 
-load_dotenv()
 
-ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
-HOST = os.getenv("HOST", "127.0.0.1")
-PORT = int(os.getenv("PORT", 8765))
-MODEL = "claude-sonnet-4-20250514"
+class Settings(NamedTuple):
+    anthropic_api_key: str
+    host: str
+    port: int
+    model: str
+    # Number of user/assistant turns kept in the conversation sent to Claude
+    history_window: int
+
+
+@functools.lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    """Load settings from the environment and .env once per process."""
+    load_dotenv()
+
+    api_key = os.getenv("ANTHROPIC_API_KEY")
+    if not api_key:
+        raise RuntimeError("ANTHROPIC_API_KEY is not set; add it to backend/.env or the environment")
+
+    return Settings(
+        anthropic_api_key=api_key,
+        host=os.getenv("HOST", "127.0.0.1"),
+        port=int(os.getenv("PORT", 8765)),
+        model=os.getenv("MODEL", "claude-sonnet-4-20250514"),
+        history_window=int(os.getenv("HISTORY_WINDOW", 10)),
+    )
+
+
+_settings = get_settings()
+
+ANTHROPIC_API_KEY = _settings.anthropic_api_key
+HOST = _settings.host
+PORT = _settings.port
+MODEL = _settings.model
+HISTORY_WINDOW = _settings.history_window
+
+
+@functools.lru_cache(maxsize=None)
+def get_client() -> anthropic.Anthropic:
+    """Shared Anthropic client, so all services reuse one HTTP/2 connection pool."""
+    http_client = anthropic.DefaultHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+    )
+    return anthropic.Anthropic(api_key=ANTHROPIC_API_KEY, http_client=http_client)
+
+
+@functools.lru_cache(maxsize=None)
+def get_async_client() -> anthropic.AsyncAnthropic:
+    """Shared async Anthropic client for issuing concurrent requests."""
+    http_client = anthropic.DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+    )
+    return anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY, http_client=http_client)
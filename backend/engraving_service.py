@@ -2,8 +2,12 @@
 Music engraving and formatting service.
 Expert agent for ensuring beautiful, standard notation.
 """
-import anthropic
-from config import ANTHROPIC_API_KEY
+import functools
+
+from config import get_client, get_async_client
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+PARTWISE_DOCTYPE = '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" "http://www.musicxml.org/dtds/partwise.dtd">\n'
 
 ENGRAVING_SYSTEM_PROMPT = """You are a master music engraver AND experienced performer. Your job is to add MUSICALLY INTELLIGENT expression to MusicXML scores - as if you were editing a score for a professional performer.
 
@@ -59,13 +63,19 @@ REQUIRED ENHANCEMENTS:
 Output: Brief summary of musical choices made, then complete MusicXML.
 """
 
+# Engraving request, assembled with a single join around the score
+ENGRAVE_PROMPT_PREFIX = "Review and improve this MusicXML score for professional engraving standards.\n\n"
+ENGRAVE_PROMPT_SCORE = "\n\n```musicxml\n"
+ENGRAVE_PROMPT_SUFFIX = "\n```\n\nApply proper engraving standards and output the complete corrected MusicXML."
+
 # Fast model for quick engraving passes
 ENGRAVING_MODEL = "claude-3-5-haiku-20241022"
 
 
 class EngravingService:
     def __init__(self):
-        self.client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+        self.client = get_client()
+        self.async_client = get_async_client()
 
     def engrave(self, musicxml: str, context: str = "") -> dict:
         """
@@ -78,25 +88,42 @@ class EngravingService:
         Returns:
             dict with 'musicxml' (engraved) and 'improvements' (list of changes)
         """
-        prompt = f"""Review and improve this MusicXML score for professional engraving standards.
+        response = self.client.messages.create(
+            model=ENGRAVING_MODEL,
+            max_tokens=8192,
+            system=ENGRAVING_SYSTEM_PROMPT,
+            messages=[{"role": "user", "content": self._build_prompt(musicxml, context)}]
+        )
 
-{f"Context: {context}" if context else ""}
+        return self._build_result(musicxml, response.content[0].text)
 
-```musicxml
-{musicxml}
-```
+    async def aengrave(self, musicxml: str, context: str = "") -> dict:
+        """
+        Async variant of engrave() that does not block the event loop while waiting on Claude.
 
-Apply proper engraving standards and output the complete corrected MusicXML."""
+        Args:
+            musicxml: Raw MusicXML to engrave
+            context: Optional context about the piece (style, instruments, etc.)
 
-        response = self.client.messages.create(
+        Returns:
+            dict with 'musicxml' (engraved) and 'improvements' (list of changes)
+        """
+        response = await self.async_client.messages.create(
             model=ENGRAVING_MODEL,
             max_tokens=8192,
             system=ENGRAVING_SYSTEM_PROMPT,
-            messages=[{"role": "user", "content": prompt}]
+            messages=[{"role": "user", "content": self._build_prompt(musicxml, context)}]
         )
 
-        result_text = response.content[0].text
+        return self._build_result(musicxml, response.content[0].text)
+
+    def _build_prompt(self, musicxml: str, context: str) -> str:
+        """Build the engraving request for a score."""
+        context_line = "Context: " + context if context else ""
+        return ''.join([ENGRAVE_PROMPT_PREFIX, context_line, ENGRAVE_PROMPT_SCORE, musicxml, ENGRAVE_PROMPT_SUFFIX])
 
+    def _build_result(self, musicxml: str, result_text: str) -> dict:
+        """Extract the engraved score and improvement notes from a response."""
         # Extract MusicXML from response
         engraved_xml = self._extract_musicxml(result_text)
 
@@ -111,28 +138,26 @@ Apply proper engraving standards and output the complete corrected MusicXML."""
 
     def _extract_musicxml(self, text: str) -> str | None:
         """Extract MusicXML from markdown code blocks."""
-        import re
-
         # Try musicxml block first
-        pattern = r'```musicxml\s*(.*?)\s*```'
-        match = re.search(pattern, text, re.DOTALL)
-        if match:
-            return match.group(1).strip()
+        start = text.find('```musicxml')
+        if start != -1:
+            end = text.find('```', start + 11)
+            if end != -1:
+                return text[start + 11:end].strip()
 
         # Try xml block
-        pattern = r'```xml\s*(.*?)\s*```'
-        match = re.search(pattern, text, re.DOTALL)
-        if match:
-            xml_content = match.group(1).strip()
-            if '<score-partwise' in xml_content:
-                return xml_content
+        start = text.find('```xml')
+        if start != -1:
+            end = text.find('```', start + 6)
+            if end != -1:
+                xml_content = text[start + 6:end].strip()
+                if '<score-partwise' in xml_content:
+                    return xml_content
 
         return None
 
     def _extract_improvements(self, text: str) -> list[str]:
         """Extract the list of improvements made."""
-        import re
-
         # Get text before the code block
         code_start = text.find('```')
         if code_start == -1:
@@ -140,35 +165,44 @@ Apply proper engraving standards and output the complete corrected MusicXML."""
 
         preamble = text[:code_start].strip()
 
-        # Extract bullet points
+        # Extract bullet points, stopping once we have 5
         improvements = []
-        for line in preamble.split('\n'):
+        for line in preamble.splitlines():
             line = line.strip()
-            if line.startswith(('-', '*', '•')):
+            if not line:
+                continue
+            first = line[0]
+            if first in '-*•':
                 improvements.append(line.lstrip('-*• ').strip())
-            elif line.startswith(('1.', '2.', '3.')):
-                improvements.append(line.split('.', 1)[1].strip())
+            elif first.isdigit() and len(line) > 1 and line[1] == '.':
+                improvements.append(line[2:].strip())
+            if len(improvements) >= 5:
+                break
 
-        return improvements[:5]  # Limit to 5 improvements
+        return improvements
 
     def quick_fix(self, musicxml: str) -> str:
         """
         Apply quick programmatic fixes without AI.
         For immediate improvements that don't need AI review.
         """
-        # Add XML declaration if missing
-        if not musicxml.strip().startswith('<?xml'):
-            musicxml = '<?xml version="1.0" encoding="UTF-8"?>\n' + musicxml
-
-        # Ensure DOCTYPE is present (some renderers need it)
-        if '<!DOCTYPE' not in musicxml and '<score-partwise' in musicxml:
-            musicxml = musicxml.replace(
-                '<score-partwise',
-                '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" "http://www.musicxml.org/dtds/partwise.dtd">\n<score-partwise',
-                1
-            )
-
-        return musicxml
+        return _quick_fix(musicxml)
+
+
+@functools.lru_cache(maxsize=32)
+def _quick_fix(musicxml: str) -> str:
+    """Add a missing XML declaration and DOCTYPE in a single pass."""
+    # Add XML declaration if missing
+    declaration = '' if musicxml.lstrip().startswith('<?xml') else XML_DECLARATION
+
+    # Ensure DOCTYPE is present before the root (some renderers need it)
+    score_start = musicxml.find('<score-partwise')
+    needs_doctype = score_start != -1 and musicxml.find('<!DOCTYPE', 0, score_start) == -1
+
+    if not needs_doctype:
+        return declaration + musicxml if declaration else musicxml
+
+    return ''.join([declaration, musicxml[:score_start], PARTWISE_DOCTYPE, musicxml[score_start:]])
 
 
 # Singleton instance
@@ -1,125 +1,238 @@
 """
 MusicXML parsing, validation, and generation utilities.
 """
+import functools
+import threading
 from lxml import etree
-from io import BytesIO
-from typing import Optional
+from typing import Optional, Union
+from xml.sax.saxutils import quoteattr
 
 
 MUSICXML_DOCTYPE = '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" "http://www.musicxml.org/dtds/partwise.dtd">'
 
+# Precompiled XPath expressions, reused across calls
+_XP_PART_BY_ID = etree.XPath('.//part[@id=$pid]')
+_XP_PARTS = etree.XPath('part')
+_XP_MEASURES = etree.XPath('measure')
+_XP_MEASURE_COUNT = etree.XPath('count(measure)')
 
-def validate_musicxml(xml_string: str) -> tuple[bool, Optional[str]]:
+
+# Output is consumed by renderers, not people; enable to make it readable while debugging
+PRETTY_PRINT = False
+
+# Parse byte-templated scores before returning them; enable while changing the templates
+VALIDATE_GENERATED = False
+
+# Byte templates for create_empty_score measures
+_REST_NOTE = b'<note><rest/><duration>1</duration><type>quarter</type></note>'
+_MEASURE_OPEN = b'<measure number="%d">'
+_ATTRIBUTES = (b'<attributes><divisions>1</divisions><key><fifths>%d</fifths></key>'
+               b'<time><beats>%d</beats><beat-type>%d</beat-type></time>'
+               b'<clef><sign>%s</sign><line>%s</line></clef></attributes>')
+_TEMPO_DIRECTION = (b'<direction placement="above"><direction-type><metronome>'
+                    b'<beat-unit>quarter</beat-unit><per-minute>%d</per-minute>'
+                    b'</metronome></direction-type><sound tempo="%d"/></direction>')
+
+
+_tls = threading.local()
+
+
+def _parser() -> etree.XMLParser:
     """
-    Validate MusicXML content.
+    Per-thread reusable parser.
+
+    DTD loading and network access are disabled (MusicXML declares a remote
+    DOCTYPE), and blank text nodes are dropped to keep trees small. Entity
+    handling stays at the default so undefined entities are still errors.
+    """
+    parser = getattr(_tls, 'parser', None)
+    if parser is None:
+        parser = etree.XMLParser(
+            load_dtd=False,
+            no_network=True,
+            remove_blank_text=True
+        )
+        _tls.parser = parser
+    return parser
+
+
+def _to_bytes(xml: Union[str, bytes]) -> bytes:
+    """Return XML as UTF-8 bytes, passing bytes through untouched."""
+    return xml if isinstance(xml, (bytes, bytearray)) else xml.encode('utf-8')
+
+
+def _serialize(root: etree._Element, pretty: bool = None) -> bytes:
+    """Serialize an element tree to UTF-8 bytes, compact unless pretty printing is requested."""
+    if pretty is None:
+        pretty = PRETTY_PRINT
+    return etree.tostring(root, encoding='utf-8', pretty_print=pretty)
+
+
+def _first(elements: list) -> Optional[etree._Element]:
+    """Return the first element of an XPath result, or None."""
+    return elements[0] if elements else None
+
+
+def _check_root(root: etree._Element) -> tuple[bool, Optional[str], int]:
+    """Check the structure of a parsed score and count its parts."""
+    if root.tag not in ('score-partwise', 'score-timewise'):
+        return False, f"Invalid root element: {root.tag}. Expected 'score-partwise' or 'score-timewise'", 0
+
+    if root.find('part-list') is None:
+        return False, "Missing required <part-list> element", 0
+
+    parts = _XP_PARTS(root)
+    if not parts:
+        return False, "No <part> elements found", 0
+
+    for part in parts:
+        if not _XP_MEASURE_COUNT(part):
+            return False, f"Part '{part.get('id', 'unknown')}' has no measures", len(parts)
+
+    return True, None, len(parts)
+
+
+def check_structure(xml_string: Union[str, bytes]) -> tuple[bool, Optional[str], int]:
+    """
+    Check MusicXML structure and count its parts.
 
     Args:
-        xml_string: MusicXML content as string
+        xml_string: MusicXML content as string or UTF-8 bytes
 
     Returns:
-        Tuple of (is_valid, error_message)
+        Tuple of (is_valid, error_message, part_count)
     """
     try:
-        root = etree.fromstring(xml_string.encode('utf-8'))
-
-        if root.tag not in ('score-partwise', 'score-timewise'):
-            return False, f"Invalid root element: {root.tag}. Expected 'score-partwise' or 'score-timewise'"
+        root = etree.fromstring(_to_bytes(xml_string), _parser())
+    except etree.XMLSyntaxError as e:
+        return False, f"XML syntax error: {str(e)}", 0
+    except Exception as e:
+        return False, f"Validation error: {str(e)}", 0
 
-        part_list = root.find('part-list')
-        if part_list is None:
-            return False, "Missing required <part-list> element"
+    return _check_root(root)
 
-        parts = root.findall('part')
-        if len(parts) == 0:
-            return False, "No <part> elements found"
 
-        for part in parts:
-            measures = part.findall('measure')
-            if len(measures) == 0:
-                part_id = part.get('id', 'unknown')
-                return False, f"Part '{part_id}' has no measures"
+def validate_musicxml(xml_string: Union[str, bytes]) -> tuple[bool, Optional[str]]:
+    """
+    Validate MusicXML content.
 
-        return True, None
+    Args:
+        xml_string: MusicXML content as string or UTF-8 bytes
 
-    except etree.XMLSyntaxError as e:
-        return False, f"XML syntax error: {str(e)}"
-    except Exception as e:
-        return False, f"Validation error: {str(e)}"
+    Returns:
+        Tuple of (is_valid, error_message)
+    """
+    is_valid, error, _ = check_structure(xml_string)
+    return is_valid, error
 
 
-def parse_score_info(xml_string: str) -> dict:
+def parse_score_info(xml_string: Union[str, bytes]) -> dict:
     """
     Extract basic information from a MusicXML score.
 
     Args:
-        xml_string: MusicXML content
+        xml_string: MusicXML content as string or UTF-8 bytes
 
     Returns:
         Dictionary with score metadata
     """
     try:
-        root = etree.fromstring(xml_string.encode('utf-8'))
-
-        info = {
-            "title": None,
-            "composer": None,
-            "parts": [],
-            "measures": 0,
-            "key": None,
-            "time_signature": None
-        }
-
-        work_title = root.find('.//work-title')
-        if work_title is not None:
-            info["title"] = work_title.text
-
-        creator = root.find('.//creator[@type="composer"]')
-        if creator is not None:
+        root = etree.fromstring(_to_bytes(xml_string), _parser())
+        return _score_info(root)
+
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def _score_info(root: etree._Element) -> dict:
+    """Collect parse_score_info's metadata from a parsed score."""
+    info = {
+        "title": None,
+        "composer": None,
+        "parts": [],
+        "measures": 0,
+        "key": None,
+        "time_signature": None
+    }
+
+    # The header layout is fixed, so walk direct children instead of scanning the document
+    work_title = root.find('work/work-title')
+    if work_title is not None:
+        info["title"] = work_title.text
+
+    for creator in root.iterfind('identification/creator'):
+        if creator.get('type') == 'composer':
             info["composer"] = creator.text
+            break
+
+    for score_part in root.iterfind('part-list/score-part'):
+        part_name = score_part.find('part-name')
+        info["parts"].append({
+            "id": score_part.get('id'),
+            "name": part_name.text if part_name is not None else "Unnamed"
+        })
 
-        for score_part in root.findall('.//score-part'):
-            part_name = score_part.find('part-name')
-            info["parts"].append({
-                "id": score_part.get('id'),
-                "name": part_name.text if part_name is not None else "Unnamed"
-            })
+    first_part = root.find('part')
+    first_measure = None
+    if first_part is not None:
+        info["measures"] = int(_XP_MEASURE_COUNT(first_part))
+        first_measure = first_part.find('measure')
 
-        first_part = root.find('.//part')
-        if first_part is not None:
-            info["measures"] = len(first_part.findall('measure'))
+    if first_measure is not None:
+        fifths = first_measure.find('attributes/key/fifths')
+        if fifths is not None:
+            info["key"] = fifths_to_key(int(fifths.text))
 
-        first_measure = root.find('.//measure')
-        if first_measure is not None:
-            fifths = first_measure.find('.//fifths')
-            if fifths is not None:
-                info["key"] = fifths_to_key(int(fifths.text))
+        time_elem = first_measure.find('attributes/time')
+        if time_elem is not None:
+            beats = time_elem.find('beats')
+            beat_type = time_elem.find('beat-type')
+            if beats is not None and beat_type is not None:
+                info["time_signature"] = f"{beats.text}/{beat_type.text}"
 
-            time_elem = first_measure.find('.//time')
-            if time_elem is not None:
-                beats = time_elem.find('beats')
-                beat_type = time_elem.find('beat-type')
-                if beats is not None and beat_type is not None:
-                    info["time_signature"] = f"{beats.text}/{beat_type.text}"
+    return info
 
-        return info
 
+def parse_all(xml_string: Union[str, bytes]) -> tuple[bool, Optional[str], Optional[dict]]:
+    """
+    Validate a score and extract its metadata from a single parse.
+
+    Args:
+        xml_string: MusicXML content as string or UTF-8 bytes
+
+    Returns:
+        Tuple of (is_valid, error_message, info); info matches parse_score_info
+        and is None when the document is not well-formed
+    """
+    try:
+        root = etree.fromstring(_to_bytes(xml_string), _parser())
+    except etree.XMLSyntaxError as e:
+        return False, f"XML syntax error: {str(e)}", None
     except Exception as e:
-        return {"error": str(e)}
+        return False, f"Validation error: {str(e)}", None
+
+    is_valid, error, _ = _check_root(root)
+    try:
+        info = _score_info(root)
+    except Exception as e:
+        info = {"error": str(e)}
+    return is_valid, error, info
+
+
+_MAJOR_KEYS = ('C', 'G', 'D', 'A', 'E', 'B', 'F#', 'C#',
+               'F', 'Bb', 'Eb', 'Ab', 'Db', 'Gb', 'Cb')
+_MINOR_KEYS = ('a', 'e', 'b', 'f#', 'c#', 'g#', 'd#', 'a#',
+               'd', 'g', 'c', 'f', 'bb', 'eb', 'ab')
 
 
 def fifths_to_key(fifths: int, mode: str = "major") -> str:
     """Convert fifths value to key name."""
-    major_keys = ['C', 'G', 'D', 'A', 'E', 'B', 'F#', 'C#',
-                  'F', 'Bb', 'Eb', 'Ab', 'Db', 'Gb', 'Cb']
-    minor_keys = ['a', 'e', 'b', 'f#', 'c#', 'g#', 'd#', 'a#',
-                  'd', 'g', 'c', 'f', 'bb', 'eb', 'ab']
-
-    keys = major_keys if mode == "major" else minor_keys
+    keys = _MAJOR_KEYS if mode == "major" else _MINOR_KEYS
 
     if fifths >= 0:
         return keys[fifths] if fifths < 8 else keys[0]
-    else:
-        return keys[8 + abs(fifths)] if abs(fifths) < 8 else keys[8]
+    flats = -fifths
+    return keys[7 + flats] if flats < 8 else keys[8]
 
 
 def get_clef_info(clef_type: str) -> tuple[str, str]:
@@ -140,7 +253,7 @@ def create_empty_score(title: str = "Untitled",
                        time_sig: tuple = (4, 4),
                        key_fifths: int = 0,
                        tempo: int = 120,
-                       measures: int = 4) -> str:
+                       measures: int = 4) -> bytes:
     """
     Create an empty MusicXML score template.
 
@@ -154,11 +267,28 @@ def create_empty_score(title: str = "Untitled",
         measures: Number of empty measures
 
     Returns:
-        MusicXML string
+        MusicXML as UTF-8 bytes
     """
     if parts is None:
         parts = [{"id": "P1", "name": "Piano", "abbreviation": "Pno.", "clef": "G", "midi_program": 0}]
 
+    # Output is a pure function of the arguments, so memoize on a hashable form of them
+    parts_key = tuple(
+        (p["id"], p["name"], p.get("abbreviation", ""), p.get("clef", "G"), p.get("midi_program", 0))
+        for p in parts
+    )
+    return _create_empty_score_cached(title, composer, parts_key, tuple(time_sig), key_fifths, tempo, measures)
+
+
+_PART_FIELDS = ("id", "name", "abbreviation", "clef", "midi_program")
+
+
+@functools.lru_cache(maxsize=256)
+def _create_empty_score_cached(title: str, composer: str, parts_key: tuple, time_sig: tuple,
+                               key_fifths: int, tempo: int, measures: int) -> bytes:
+    """Build the score for create_empty_score; parts_key holds one _PART_FIELDS tuple per part."""
+    parts = [dict(zip(_PART_FIELDS, part)) for part in parts_key]
+
     root = etree.Element('score-partwise', version="4.0")
 
     # Work info
@@ -194,65 +324,48 @@ def create_empty_score(title: str = "Untitled",
         midi_program = etree.SubElement(midi_instrument, 'midi-program')
         midi_program.text = str(part_def.get("midi_program", 0) + 1)  # MIDI programs are 1-indexed in MusicXML
 
-    # Parts with measures
+    # Header and part list are serialized once; the closing root tag is re-added after the parts
+    header = etree.tostring(root, encoding='utf-8')
+    chunks = [header[:-len(b'</score-partwise>')]]
+
+    # Parts with measures, built from byte templates
+    rests = _REST_NOTE * time_sig[0]
+    later_measures = b''.join(
+        _MEASURE_OPEN % m + rests + b'</measure>' for m in range(2, measures + 1)
+    )
+
     for part_idx, part_def in enumerate(parts):
-        part = etree.SubElement(root, 'part', id=part_def["id"])
         clef_sign, clef_line = get_clef_info(part_def.get("clef", "G"))
+        chunks.append(b'<part id=%s>' % quoteattr(part_def["id"]).encode('utf-8'))
+
+        if measures >= 1:
+            chunks.append(_MEASURE_OPEN % 1)
+            chunks.append(_ATTRIBUTES % (key_fifths, time_sig[0], time_sig[1],
+                                         clef_sign.encode('utf-8'), clef_line.encode('utf-8')))
+            # Direction (tempo) - only for first part
+            if part_idx == 0:
+                chunks.append(_TEMPO_DIRECTION % (tempo, tempo))
+            chunks.append(rests)
+            chunks.append(b'</measure>')
+            chunks.append(later_measures)
+
+        chunks.append(b'</part>')
+
+    chunks.append(b'</score-partwise>')
+    body = b''.join(chunks)
+
+    if PRETTY_PRINT or VALIDATE_GENERATED:
+        # Parsing catches malformed templates; re-serializing honors PRETTY_PRINT
+        body = _serialize(etree.fromstring(body, _parser()))
+
+    xml_declaration = b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    doctype = MUSICXML_DOCTYPE.encode('utf-8') + b'\n'
+
+    return xml_declaration + doctype + body
+
 
-        for m in range(1, measures + 1):
-            measure = etree.SubElement(part, 'measure', number=str(m))
-
-            if m == 1:
-                # Attributes
-                attributes = etree.SubElement(measure, 'attributes')
-
-                divisions = etree.SubElement(attributes, 'divisions')
-                divisions.text = "1"
-
-                key = etree.SubElement(attributes, 'key')
-                fifths = etree.SubElement(key, 'fifths')
-                fifths.text = str(key_fifths)
-
-                time = etree.SubElement(attributes, 'time')
-                beats = etree.SubElement(time, 'beats')
-                beats.text = str(time_sig[0])
-                beat_type = etree.SubElement(time, 'beat-type')
-                beat_type.text = str(time_sig[1])
-
-                clef = etree.SubElement(attributes, 'clef')
-                sign = etree.SubElement(clef, 'sign')
-                sign.text = clef_sign
-                line = etree.SubElement(clef, 'line')
-                line.text = clef_line
-
-                # Direction (tempo) - only for first part
-                if part_idx == 0:
-                    direction = etree.SubElement(measure, 'direction', placement="above")
-                    direction_type = etree.SubElement(direction, 'direction-type')
-                    metronome = etree.SubElement(direction_type, 'metronome')
-                    beat_unit = etree.SubElement(metronome, 'beat-unit')
-                    beat_unit.text = "quarter"
-                    per_minute = etree.SubElement(metronome, 'per-minute')
-                    per_minute.text = str(tempo)
-                    sound = etree.SubElement(direction, 'sound', tempo=str(tempo))
-
-            # Fill with rests
-            for _ in range(time_sig[0]):
-                note = etree.SubElement(measure, 'note')
-                rest = etree.SubElement(note, 'rest')
-                duration = etree.SubElement(note, 'duration')
-                duration.text = "1"
-                note_type = etree.SubElement(note, 'type')
-                note_type.text = "quarter"
-
-    xml_declaration = '<?xml version="1.0" encoding="UTF-8"?>\n'
-    doctype = MUSICXML_DOCTYPE + '\n'
-    tree_string = etree.tostring(root, encoding='unicode', pretty_print=True)
-
-    return xml_declaration + doctype + tree_string
-
-
-def merge_musicxml(base_xml: str, new_xml: str, insert_at_measure: int = None) -> str:
+def merge_musicxml(base_xml: Union[str, bytes], new_xml: Union[str, bytes],
+                   insert_at_measure: int = None) -> bytes:
     """
     Merge new MusicXML content into an existing score.
 
@@ -262,46 +375,57 @@ def merge_musicxml(base_xml: str, new_xml: str, insert_at_measure: int = None) -
         insert_at_measure: Measure number to insert at (None = append)
 
     Returns:
-        Merged MusicXML string
+        Merged MusicXML as UTF-8 bytes
     """
     try:
-        base_root = etree.fromstring(base_xml.encode('utf-8'))
-        new_root = etree.fromstring(new_xml.encode('utf-8'))
+        base_root = etree.fromstring(_to_bytes(base_xml), _parser())
+        new_root = etree.fromstring(_to_bytes(new_xml), _parser())
 
-        for new_part in new_root.findall('part'):
+        for new_part in _XP_PARTS(new_root):
             part_id = new_part.get('id')
-            base_part = base_root.find(f".//part[@id='{part_id}']")
+            base_part = _first(_XP_PART_BY_ID(base_root, pid=part_id))
 
             if base_part is not None:
-                new_measures = new_part.findall('measure')
-                base_measures = base_part.findall('measure')
+                new_measures = _XP_MEASURES(new_part)
+                if not new_measures:
+                    continue
 
                 if insert_at_measure is None:
-                    start_num = len(base_measures) + 1
+                    start_num = int(_XP_MEASURE_COUNT(base_part)) + 1
                     for i, measure in enumerate(new_measures):
                         measure.set('number', str(start_num + i))
                         base_part.append(measure)
                 else:
-                    for i, measure in enumerate(new_measures):
-                        measure.set('number', str(insert_at_measure + i))
-
-                    insert_idx = insert_at_measure - 1
-                    for i, measure in enumerate(new_measures):
-                        base_part.insert(insert_idx + i, measure)
-
-                    for j, measure in enumerate(base_measures[insert_at_measure - 1:]):
-                        measure.set('number', str(insert_at_measure + len(new_measures) + j))
-
-        xml_declaration = '<?xml version="1.0" encoding="UTF-8"?>\n'
-        tree_string = etree.tostring(base_root, encoding='unicode', pretty_print=True)
-
-        return xml_declaration + tree_string
+                    # Find the measure currently at the insertion position
+                    anchor = None
+                    for position, measure in enumerate(base_part.iterchildren('measure'), start=1):
+                        if position >= insert_at_measure:
+                            anchor = measure
+                            break
+
+                    for measure in new_measures:
+                        if anchor is not None:
+                            anchor.addprevious(measure)
+                        else:
+                            base_part.append(measure)
+
+                    # Renumber from the first inserted measure onward in one pass
+                    number = insert_at_measure
+                    for measure in new_measures:
+                        measure.set('number', str(number))
+                        number += 1
+                    for measure in new_measures[-1].itersiblings('measure'):
+                        measure.set('number', str(number))
+                        number += 1
+
+        xml_declaration = b'<?xml version="1.0" encoding="UTF-8"?>\n'
+        return xml_declaration + _serialize(base_root)
 
     except Exception as e:
         raise ValueError(f"Failed to merge MusicXML: {str(e)}")
 
 
-def extract_measures(xml_string: str, start: int, end: int) -> str:
+def extract_measures(xml_string: Union[str, bytes], start: int, end: int) -> bytes:
     """
     Extract specific measures from a score.
 
@@ -311,28 +435,24 @@ def extract_measures(xml_string: str, start: int, end: int) -> str:
         end: Ending measure number (inclusive)
 
     Returns:
-        MusicXML with only the specified measures
+        MusicXML (UTF-8 bytes) with only the specified measures
     """
     try:
-        root = etree.fromstring(xml_string.encode('utf-8'))
+        root = etree.fromstring(_to_bytes(xml_string), _parser())
 
-        for part in root.findall('part'):
-            measures_to_remove = []
-            for measure in part.findall('measure'):
+        for part in _XP_PARTS(root):
+            # Drop out-of-range measures and renumber the kept ones in one pass
+            kept = 0
+            for measure in list(part.iterchildren('measure')):
                 num = int(measure.get('number'))
                 if num < start or num > end:
-                    measures_to_remove.append(measure)
-
-            for measure in measures_to_remove:
-                part.remove(measure)
-
-            for i, measure in enumerate(part.findall('measure')):
-                measure.set('number', str(i + 1))
-
-        xml_declaration = '<?xml version="1.0" encoding="UTF-8"?>\n'
-        tree_string = etree.tostring(root, encoding='unicode', pretty_print=True)
+                    part.remove(measure)
+                else:
+                    kept += 1
+                    measure.set('number', str(kept))
 
-        return xml_declaration + tree_string
+        xml_declaration = b'<?xml version="1.0" encoding="UTF-8"?>\n'
+        return xml_declaration + _serialize(root)
 
     except Exception as e:
         raise ValueError(f"Failed to extract measures: {str(e)}")
@@ -1,6 +1,11 @@
 """
 FastAPI server for OpenMuse - Claude-powered MuseScore chatbot.
 """
+import asyncio
+from collections import OrderedDict
+
+import cachetools
+import xxhash
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
@@ -11,8 +16,8 @@ from config import HOST, PORT
 from claude_service import ClaudeService
 from engraving_service import engraving_service
 from musicxml_utils import (
-    validate_musicxml,
-    parse_score_info,
+    check_structure,
+    parse_all,
     create_empty_score,
     merge_musicxml,
     extract_measures
@@ -34,6 +39,38 @@ app.add_middleware(
 
 claude_service = ClaudeService()
 
+# (validator name, score hash) pairs that recently passed validation in this process
+# (LRU, oldest first); keyed per validator so one validator's pass never vouches for another's
+_RECENTLY_VALIDATED: OrderedDict[tuple[str, int], None] = OrderedDict()
+_RECENTLY_VALIDATED_MAX = 1024
+
+
+def _score_key(musicxml: str) -> int:
+    """Content hash used as the cache key for a score."""
+    return xxhash.xxh3_64_intdigest(musicxml.encode('utf-8'))
+
+
+def _mark_validated(validator, musicxml: str):
+    """Record a score as valid for validator, evicting the least recently used entry when full."""
+    key = (validator.__name__, _score_key(musicxml))
+    _RECENTLY_VALIDATED[key] = None
+    _RECENTLY_VALIDATED.move_to_end(key)
+    if len(_RECENTLY_VALIDATED) > _RECENTLY_VALIDATED_MAX:
+        _RECENTLY_VALIDATED.popitem(last=False)
+
+
+async def _validate_once(musicxml: str, validator) -> tuple[bool, Optional[str]]:
+    """Validate a score in a worker thread unless validator recently passed an identical one."""
+    key = (validator.__name__, _score_key(musicxml))
+    if key in _RECENTLY_VALIDATED:
+        _RECENTLY_VALIDATED.move_to_end(key)
+        return True, None
+
+    is_valid, error = (await asyncio.to_thread(validator, musicxml))[:2]
+    if is_valid:
+        _mark_validated(validator, musicxml)
+    return is_valid, error
+
 
 class SelectionInfo(BaseModel):
     start_measure: int
@@ -120,7 +157,7 @@ async def chat(request: ChatRequest):
                 "selected_xml": request.selected_measures
             }
 
-        result = claude_service.chat(
+        result = await claude_service.achat(
             user_message=request.message,
             current_score_xml=request.current_score,
             selection_context=selection_context
@@ -132,7 +169,7 @@ async def chat(request: ChatRequest):
         )
 
         if response.musicxml:
-            is_valid, error = validate_musicxml(response.musicxml)
+            is_valid, error = await _validate_once(response.musicxml, check_structure)
             response.valid = is_valid
             response.validation_error = error
 
@@ -142,8 +179,14 @@ async def chat(request: ChatRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+from fastapi.concurrency import iterate_in_threadpool
 from fastapi.responses import StreamingResponse
-import json
+import orjson
+
+def _sse(obj) -> bytes:
+    """Encode an object as a server-sent event frame."""
+    return b'data: ' + orjson.dumps(obj) + b'\n\n'
+
 
 @app.post("/chat/stream")
 async def chat_stream(request: ChatRequest):
@@ -163,60 +206,71 @@ async def chat_stream(request: ChatRequest):
         try:
             final_xml = None
 
-            for chunk in claude_service.chat_stream(
+            # The Claude stream is synchronous; pull each chunk in a worker thread
+            async for chunk in iterate_in_threadpool(claude_service.chat_stream(
                 user_message=request.message,
                 current_score_xml=request.current_score,
                 selection_context=selection_context
-            ):
+            )):
                 # Pass through partial updates and text
                 if chunk.get("type") in ("partial", "text"):
-                    yield f"data: {json.dumps(chunk)}\n\n"
+                    yield _sse(chunk)
                 elif chunk.get("type") == "complete" and chunk.get("musicxml"):
                     final_xml = chunk["musicxml"]
                     # Signal we're now engraving
-                    yield f"data: {json.dumps({'type': 'engraving', 'status': 'Polishing notation...'})}\n\n"
+                    yield _sse({'type': 'engraving', 'status': 'Polishing notation...'})
 
             # Run engraving pass on the complete score
             if final_xml:
                 print(f"Got final XML, length: {len(final_xml)}")
 
-                # Validate the original first
-                is_valid_original, orig_error = validate_musicxml(final_xml)
+                # Validate the original first, keeping its part count for the engraved check
+                is_valid_original, orig_error, original_parts = await asyncio.to_thread(check_structure, final_xml)
                 print(f"Original validation: valid={is_valid_original}, error={orig_error}")
 
-                if not is_valid_original:
+                if is_valid_original:
+                    _mark_validated(check_structure, final_xml)
+                else:
                     # Try quick fix
                     final_xml = engraving_service.quick_fix(final_xml)
 
                 try:
                     print("Starting engraving pass...")
-                    engraved = engraving_service.engrave(final_xml)
+                    engraved = await engraving_service.aengrave(final_xml)
                     engraved_xml = engraved.get('musicxml')
                     print(f"Engraving complete, got XML: {engraved_xml is not None}")
 
                     # Validate engraved version
                     if engraved_xml:
-                        is_valid, error = validate_musicxml(engraved_xml)
+                        if is_valid_original and engraved_xml == final_xml:
+                            # Engraving fell back to the original, which is already validated
+                            is_valid, error = True, None
+                        else:
+                            is_valid, error, engraved_parts = await asyncio.to_thread(check_structure, engraved_xml)
+                            if is_valid and is_valid_original and engraved_parts != original_parts:
+                                is_valid = False
+                                error = f"Engraved score has {engraved_parts} parts, expected {original_parts}"
                         print(f"Engraved validation: valid={is_valid}, error={error}")
                         if is_valid:
-                            yield f"data: {json.dumps({'type': 'complete', 'musicxml': engraved_xml, 'improvements': engraved.get('improvements', [])})}\n\n"
+                            _mark_validated(check_structure, engraved_xml)
+                            yield _sse({'type': 'complete', 'musicxml': engraved_xml, 'improvements': engraved.get('improvements', [])})
                         else:
                             print(f"Engraved invalid, using original")
-                            yield f"data: {json.dumps({'type': 'complete', 'musicxml': final_xml})}\n\n"
+                            yield _sse({'type': 'complete', 'musicxml': final_xml})
                     else:
                         print("No engraved XML returned, using original")
-                        yield f"data: {json.dumps({'type': 'complete', 'musicxml': final_xml})}\n\n"
+                        yield _sse({'type': 'complete', 'musicxml': final_xml})
                 except Exception as e:
                     # If engraving fails, use the original
                     print(f"Engraving exception: {e}, using original")
-                    yield f"data: {json.dumps({'type': 'complete', 'musicxml': final_xml})}\n\n"
+                    yield _sse({'type': 'complete', 'musicxml': final_xml})
             else:
                 print("No final XML from composition")
-                yield f"data: {json.dumps({'type': 'complete', 'musicxml': None})}\n\n"
+                yield _sse({'type': 'complete', 'musicxml': None})
 
-            yield "data: [DONE]\n\n"
+            yield b'data: [DONE]\n\n'
         except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            yield _sse({'error': str(e)})
 
     return StreamingResponse(
         generate(),
@@ -234,7 +288,8 @@ async def generate(request: GenerateRequest):
     Generate music from a description with specific parameters.
     """
     try:
-        result = claude_service.generate_from_description(
+        result = await asyncio.to_thread(
+            claude_service.generate_from_description,
             description=request.description,
             key=request.key,
             time_sig=(request.time_beats, request.time_beat_type),
@@ -247,7 +302,7 @@ async def generate(request: GenerateRequest):
         )
 
         if response.musicxml:
-            is_valid, error = validate_musicxml(response.musicxml)
+            is_valid, error = await _validate_once(response.musicxml, check_structure)
             response.valid = is_valid
             response.validation_error = error
 
@@ -263,26 +318,37 @@ async def analyze(request: ValidateRequest):
     Analyze a MusicXML score.
     """
     try:
-        result = claude_service.analyze_score(request.musicxml)
+        result = await asyncio.to_thread(claude_service.analyze_score, request.musicxml)
         return {"analysis": result["text"]}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Results of the pure /validate and /score/info endpoints, keyed by a hash of the score;
+# the frontend resends unchanged scores, so a hit skips the parse entirely
+_VALIDATE_CACHE = cachetools.TTLCache(maxsize=512, ttl=60)
+_INFO_CACHE = cachetools.TTLCache(maxsize=512, ttl=60)
+
+
 @app.post("/validate")
 async def validate(request: ValidateRequest):
     """
     Validate MusicXML content.
     """
-    is_valid, error = validate_musicxml(request.musicxml)
-    info = parse_score_info(request.musicxml) if is_valid else None
+    key = _score_key(request.musicxml)
+    result = _VALIDATE_CACHE.get(key)
+    if result is None:
+        is_valid, error, info = await asyncio.to_thread(parse_all, request.musicxml)
+
+        result = {
+            "valid": is_valid,
+            "error": error,
+            "info": info if is_valid else None
+        }
+        _VALIDATE_CACHE[key] = result
 
-    return {
-        "valid": is_valid,
-        "error": error,
-        "info": info
-    }
+    return result
 
 
 @app.post("/score/new")
@@ -305,7 +371,8 @@ async def new_score(request: NewScoreRequest):
                 for i, inst in enumerate(request.instruments)
             ]
 
-        xml = create_empty_score(
+        xml = await asyncio.to_thread(
+            create_empty_score,
             title=request.title,
             composer=request.composer,
             parts=parts,
@@ -314,7 +381,7 @@ async def new_score(request: NewScoreRequest):
             tempo=request.tempo,
             measures=request.measures
         )
-        return {"musicxml": xml}
+        return {"musicxml": xml.decode('utf-8')}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -326,12 +393,13 @@ async def merge_scores(request: MergeRequest):
     Merge new content into an existing score.
     """
     try:
-        result = merge_musicxml(
+        result = await asyncio.to_thread(
+            merge_musicxml,
             base_xml=request.base_xml,
             new_xml=request.new_xml,
             insert_at_measure=request.insert_at_measure
         )
-        return {"musicxml": result}
+        return {"musicxml": result.decode('utf-8')}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -343,12 +411,13 @@ async def extract(request: ExtractRequest):
     Extract specific measures from a score.
     """
     try:
-        result = extract_measures(
+        result = await asyncio.to_thread(
+            extract_measures,
             xml_string=request.musicxml,
             start=request.start_measure,
             end=request.end_measure
         )
-        return {"musicxml": result}
+        return {"musicxml": result.decode('utf-8')}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -368,13 +437,27 @@ async def score_info(musicxml: str):
     """
     Get information about a MusicXML score.
     """
-    return parse_score_info(musicxml)
+    key = _score_key(musicxml)
+    info = _INFO_CACHE.get(key)
+    if info is None:
+        _, error, info = await asyncio.to_thread(parse_all, musicxml)
+        if info is None:
+            info = {"error": error}
+        _INFO_CACHE[key] = info
+    return info
 
 
 def main():
     """Start the server."""
     print(f"Starting OpenMuse API server on http://{HOST}:{PORT}")
-    uvicorn.run(app, host=HOST, port=PORT)
+    # One worker only: conversation history lives in this process's ClaudeService
+    uvicorn.run(
+        app,
+        host=HOST,
+        port=PORT,
+        log_level='warning',
+        access_log=False,
+    )
 
 
 if __name__ == "__main__":